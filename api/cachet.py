@@ -1,23 +1,87 @@
+import collections
+import functools
+import inspect
+import itertools
 import json
 import requests
-import sys
+import threading
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from operator import itemgetter
 
 
+class CachetHttpError(Exception):
+    def __init__(self, url, code, message):
+        super(CachetHttpError, self).__init__(
+            'ClientHttpError[%s, %s: %s]' % (url, code, message)
+        )
+        self.url = url
+        self.code = code
+
+    @property
+    def permanent(self):
+        """Request was rejected by Cachet and retrying will not help"""
+        return self.code is not None and 400 <= self.code < 500 \
+            and self.code != 429
+
+
 def client_http_error(url, code, message):
     """Logging HTTP errors
     """
-    logging.error('ClientHttpError[%s, %s: %s]' % (url, code, message))
-    sys.exit(1)
+    error = CachetHttpError(url, code, message)
+    logging.error(str(error))
+    return error
+
+
+def outbox_write(key):
+    """Route Cachet write through the outbox if it is enabled
+
+    With the outbox the write is queued and sent by flush_outbox,
+    so decorated method returns None instead of Cachet response.
+    :param key: template of outbox key, writes with same key are merged
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if self.outbox is None:
+                return func(self, *args, **kwargs)
+            params = {}
+            arguments = signature.bind(self, *args, **kwargs).arguments
+            for name, value in arguments.items():
+                if name == 'self':
+                    continue
+                if signature.parameters[name].kind == \
+                        inspect.Parameter.VAR_KEYWORD:
+                    params.update(value)
+                else:
+                    params[name] = value
+            self.outbox.put(key.format(**params), func.__name__, params)
+            self.flush_outbox()
+        return wrapper
+    return decorator
 
 
 class Cachet:
-    def __init__(self, server, token, verify=True):
+    def __init__(self, server, token, verify=True, adapter=None,
+                 outbox=None, breaker=None, timeout=30,
+                 per_page=100, page_window=4, events=None, pool_size=10,
+                 progress=None):
         """Init Cachet class for further needs
 
         : param server: string
         :param token: string
+        :param adapter: requests transport adapter (e.g. trace recorder)
+        :param outbox: Outbox object for pending writes
+        :param breaker: CircuitBreaker object
+        :param timeout: HTTP request timeout in seconds
+        :param per_page: items per page for list endpoints
+        :param page_window: max number of pages fetched in parallel
+        :param events: EventStream object for applied changes
+        :param pool_size: max number of kept connections to Cachet
+        :param progress: callable called by the thread which consumes
+                         pages prefetched in background
         :return: object
         """
         self.server = server + '/api/v1/'
@@ -27,37 +91,66 @@ class Cachet:
             'Accept': 'application/json; indent=4'
         }
         self.verify = verify
+        self.timeout = timeout
+        self.per_page = per_page
+        self.page_window = page_window
+        self.executor = ThreadPoolExecutor(max_workers=page_window)
+        self.events = events
+        self.progress = progress
+        self.session = requests.Session()
+        if adapter is None:
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.outbox = outbox
+        self.outbox_lock = threading.Lock()
+        self.breaker = breaker
 
-    def _http_error(url, code, message):
-        """Print error message and exit if has request errors
-        """
-        logging.error('ClientHttpError[%s, %s: %s]' % (url, code, message))
-        sys.exit(1)
-
-    def _http_post(self, url, params):
-        """Make POST and return json response
+    def _http_request(self, method, url, **kwargs):
+        """Make HTTP request and return json response
 
+        Raise CachetHttpError on connection error or non-200 response
+        :param method: str
         :param url: str
-        :param params: dict
         :return: json
         """
         url = self.server + url
+        if self.breaker is not None and not self.breaker.allow():
+            raise CachetHttpError(url, None, 'circuit breaker is open')
         try:
-            r = requests.post(
+            r = self.session.request(
+                method,
                 url=url,
-                data=params,
                 headers=self.headers,
-                verify=self.verify
+                verify=self.verify,
+                timeout=self.timeout,
+                **kwargs
             )
         except requests.exceptions.RequestException as e:
-            raise self._http_error(url, None, e)
+            if self.breaker is not None:
+                self.breaker.failure()
+            raise client_http_error(url, None, e)
         # r.raise_for_status()
         if r.status_code != 200:
-            return self._http_error(url, r.status_code, r.text)
+            error = client_http_error(url, r.status_code, r.text)
+            if self.breaker is not None and not error.permanent:
+                self.breaker.failure()
+            raise error
+        if self.breaker is not None:
+            self.breaker.success()
         data = json.loads(r.text)
         # TODO: check data
         return data
 
+    def _http_post(self, url, params):
+        """Make POST and return json response
+
+        :param url: str
+        :param params: dict
+        :return: json
+        """
+        return self._http_request('POST', url, data=params)
+
     def _http_get(self, url, params=None):
         """
         Helper for HTTP GET request
@@ -67,23 +160,7 @@ class Cachet:
         """
         if params is None:
             params = {}
-        url = self.server + url
-        try:
-            r = requests.get(
-                url=url,
-                headers=self.headers,
-                params=params,
-                verify=self.verify
-            )
-        except requests.exceptions.RequestException as e:
-            raise client_http_error(url, None, e)
-        # r.raise_for_status()
-        if r.status_code != 200:
-            return client_http_error(url, r.status_code,
-                                     json.loads(r.text)['errors'])
-        data = json.loads(r.text)
-        # TODO: check data
-        return data
+        return self._http_request('GET', url, params=params)
 
     def _http_put(self, url, params):
         """
@@ -92,22 +169,101 @@ class Cachet:
         :param params: dict
         :return: json
         """
-        url = self.server + url
+        return self._http_request('PUT', url, json=params)
+
+    def _pages(self, url, params=None, reverse=False, ramp=False):
+        """
+        Iterate over pages of list endpoint
+        Number of pages is taken from the first page, the rest are
+        prefetched in parallel, at most page_window at once.
+        Pending requests are cancelled when iteration is stopped.
+        @param url: string
+        @param params: dict
+        @param reverse: start from the last page
+        @param ramp: start with one page and double the window after
+                     every page. For lookups which usually stop early
+        @return: generator of lists
+        """
+        params = dict(params or {}, per_page=self.per_page)
+        first = self._http_get(url, dict(params, page=1))
+        total_pages = int(first['meta']['pagination']['total_pages'])
+        if not reverse:
+            yield first['data']
+        if total_pages > 1:
+            if reverse:
+                pages = iter(range(total_pages, 1, -1))
+            else:
+                pages = iter(range(2, total_pages + 1))
+            window = 1 if ramp else self.page_window
+            futures = collections.deque()
+            try:
+                while True:
+                    for page in itertools.islice(pages,
+                                                 window - len(futures)):
+                        futures.append(self.executor.submit(
+                            self._http_get, url, dict(params, page=page)
+                        ))
+                    if not futures:
+                        break
+                    data = futures.popleft().result()
+                    if self.progress is not None:
+                        self.progress()
+                    window = min(window * 2, self.page_window)
+                    yield data['data']
+            finally:
+                for future in futures:
+                    future.cancel()
+        if reverse:
+            yield first['data']
+
+    def paginate(self, url, params=None, reverse=False, ramp=False):
+        """
+        Iterate over all items of list endpoint
+        @param url: string
+        @param params: dict
+        @param reverse: start from the last page
+        @param ramp: see _pages
+        @return: generator of dicts
+        """
+        for page in self._pages(url, params, reverse, ramp):
+            for item in page:
+                yield item
+
+    def _emit(self, type, **data):
+        """Record a change which was applied to Cachet"""
+        if self.events is not None:
+            self.events.emit(type, **data)
+
+    def flush_outbox(self):
+        """Send pending writes from the outbox in order of arrival
+
+        Stop on the first failure and keep the rest for the next attempt.
+        Writes rejected by Cachet (4xx) are dropped, as well as writes
+        which got 5xx for outbox.max_attempts times.
+        :return: number of sent writes, int
+        """
+        if self.outbox is None or not self.outbox_lock.acquire(False):
+            return 0
+        sent = 0
         try:
-            r = requests.put(
-                url=url,
-                json=params,
-                headers=self.headers,
-                verify=self.verify
-            )
-        except requests.exceptions.RequestException as e:
-            raise client_http_error(url, None, e)
-        # r.raise_for_status()
-        if r.status_code != 200:
-            return client_http_error(url, r.status_code, r.text)
-        data = json.loads(r.text)
-        # TODO: check data
-        return data
+            for id, method, params in self.outbox.items():
+                try:
+                    getattr(Cachet, method).__wrapped__(self, **params)
+                except CachetHttpError as e:
+                    if e.permanent or e.code is not None and \
+                            self.outbox.failed(id) >= self.outbox.max_attempts:
+                        logging.error('Dropping {} from outbox: {}'.format(
+                            method, e))
+                        self.outbox.delete(id)
+                        continue
+                    logging.warning('Cachet is unavailable, {} writes are '
+                                    'kept in outbox'.format(len(self.outbox)))
+                    break
+                self.outbox.delete(id)
+                sent += 1
+        finally:
+            self.outbox_lock.release()
+        return sent
 
     def get_component(self, id):
         """
@@ -119,6 +275,13 @@ class Cachet:
         data = self._http_get(url)
         return data
 
+    def get_components(self):
+        """
+        Get all registered components
+        @return: list of dicts
+        """
+        return list(self.paginate('components'))
+
     def get_component_by_name(self, name=None):
         """
         Get registered component or return id=0
@@ -126,21 +289,18 @@ class Cachet:
         @param name: string
         @return: dict
         """
-        url = 'components'
-        data = self._http_get(url)
         if name:
-            total_pages = int(data['meta']['pagination']['total_pages'])
-            for page in range(1,total_pages+1):
-                data = self._http_get(url,{'page': page})
-                for component in data['data']:
-                    if component['name'] == name:
-                        return component;
+            for component in self.paginate('components', ramp=True):
+                if component['name'] == name:
+                    return component
         return {'id': 0, 'name': 'Does not exists'}
 
-    def new_components(self, name, **kwargs):
+    def new_components(self, name, check_existing=True, **kwargs):
         """
         Create new components
         @param name: string
+        @param check_existing: look for component with same name first.
+                               Disable if caller has already checked it
         @param kwargs: various additional values =)
         @return: dict of data
         """
@@ -155,7 +315,10 @@ class Cachet:
         }
         params.update(kwargs)
         # Check if components with same name already exists in same group
-        component = self.get_component_by_name(name)
+        if check_existing:
+            component = self.get_component_by_name(name)
+        else:
+            component = {'id': 0}
 
         # Create component if it does not exist or exist in other group
         if component['id'] == 0 or component['group_id'] != params['group_id']:
@@ -177,12 +340,13 @@ class Cachet:
         else:
             return component
 
+    @outbox_write('component:{id}')
     def upd_components(self, id, **kwargs):
         """
         Update component
         @param id: string
         @param kwargs: various additional values =)
-        @return: boolean
+        @return: boolean, None if write was queued in outbox
         """
         url = 'components/' + str(id)
         params = self.get_component(id)['data']
@@ -194,6 +358,9 @@ class Cachet:
                 id=id,
                 status=data['data']['status_name'])
         )
+        self._emit('component.status', component_id=id,
+                   name=data['data']['name'],
+                   status=data['data']['status'])
         return data
 
     def get_components_gr(self, name=None):
@@ -204,24 +371,29 @@ class Cachet:
         @return: dict of data
         """
         url = 'components/groups'
-        data = self._http_get(url)
         if name:
-            for group in data['data']:
+            for group in self.paginate(url, ramp=True):
                 if group['name'] == name:
                     return group
             else:
                 return {'id': 0, 'name': 'Does not exists'}
+        data = self._http_get(url)
         return data
 
-    def new_components_gr(self, name, order):
+    def new_components_gr(self, name, order, check_existing=True):
         """
         Create new components group
         @param name: string
         @param order: string
+        @param check_existing: look for group with same name first.
+                               Disable if caller has already checked it
         @return: dict of data
         """
         # Check if component's group already exists
-        componenets_gr_id = self.get_components_gr(name)
+        if check_existing:
+            componenets_gr_id = self.get_components_gr(name)
+        else:
+            componenets_gr_id = {'id': 0}
         if componenets_gr_id['id'] == 0:
             url = 'components/groups'
             # TODO: make if possible to configure default collapsed value
@@ -245,12 +417,9 @@ class Cachet:
         """
         # TODO: make search by name
         url = 'incidents'
-        data = self._http_get(url)
-        total_pages = int(data['meta']['pagination']['total_pages'])
-        for page in range(total_pages, 0, -1):
-            data = self._http_get(url, params={'page': page})
+        for page in self._pages(url, reverse=True, ramp=True):
             data_sorted = sorted(
-                data['data'],
+                page,
                 key=itemgetter('id'),
                 reverse=True
             )
@@ -261,13 +430,14 @@ class Cachet:
                     return incident
         return {'id': '0', 'name': 'Does not exist', 'status': '-1'}
 
+    @outbox_write('incident:component:{component_id}')
     def new_incidents(self, **kwargs):
         """
         Create a new incident.
         @param kwargs: various additional values =)
                         name, message, status,
                         component_id, component_status
-        @return: dict of data
+        @return: dict of data, None if write was queued in outbox
         """
         params = {'visible': 1, 'notify': 'true'}
         url = 'incidents'
@@ -279,8 +449,13 @@ class Cachet:
                         incident_id=data['data']['id'],
                         component_id=params['component_id']
         ))
+        self._emit('incident.open', incident_id=data['data']['id'],
+                   name=params['name'], status=params['status'],
+                   component_id=params['component_id'],
+                   component_status=params.get('component_status'))
         return data['data']
 
+    @outbox_write('incident:{id}')
     def upd_incident(self, id, **kwargs):
         """
         Update incident
@@ -288,7 +463,7 @@ class Cachet:
         @param kwargs: various additional values =)
                 message, status,
                 component_status
-        @return: boolean
+        @return: boolean, None if write was queued in outbox
         """
         url = 'incidents/' + str(id)
         params = kwargs
@@ -297,19 +472,18 @@ class Cachet:
             id=id,
             status=data['data']['human_status'])
         )
+        self._emit(
+            'incident.resolve' if str(kwargs.get('status')) == '4'
+            else 'incident.update',
+            incident_id=id, status=kwargs.get('status'),
+            component_id=kwargs.get('component_id'),
+            component_status=kwargs.get('component_status')
+        )
         return data
 
     def get_metrics(self):
         url = 'metrics'
-        response = self._http_get(url)
-        pag_info = response['meta']['pagination']
-
-        # If we didn't get all objects - try again
-        if pag_info['total_pages'] > 1:
-            # Get objects from a big pagination page
-            return self._http_get(url, {'per_page': pag_info['total']})['data']
-
-        return response['data']
+        return list(self.paginate(url))
 
     def create_metrics(self, **kwargs):
         url = 'metrics'
@@ -323,7 +497,15 @@ class Cachet:
 
         return data
 
+    @outbox_write('metric:{id}:{timestamp}')
     def add_point_to_metric(self, id, value, timestamp):
+        """
+        Add point to metric
+        @param id: string
+        @param value: float
+        @param timestamp: int
+        @return: dict of data, None if write was queued in outbox
+        """
         url = 'metrics/{id}/points'.format(id=id)
         params = {
             'value': value,
@@ -331,5 +513,7 @@ class Cachet:
         }
 
         data = self._http_post(url, params)
+        self._emit('metric.point', metric_id=id, value=value,
+                   timestamp=timestamp)
         return data
 
@@ -0,0 +1,43 @@
+import json
+import logging
+import logging.handlers
+import os
+import time
+
+
+class EventStream:
+    def __init__(self, path, max_bytes=10485760, backup_count=5):
+        """Append-only JSONL log of changes applied to Cachet
+
+        Every line is a JSON object with 'time' and 'type' keys.
+        The file is rotated when it grows over max_bytes.
+        :param path: path to log file, string
+        :param max_bytes: size of file before rotation, int
+        :param backup_count: number of rotated files to keep, int
+        """
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.logger = logging.getLogger('zabbix-cachet.events.' + path)
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backup_count
+        )
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self.logger.addHandler(handler)
+
+    def emit(self, type, **data):
+        """Write one event
+
+        :param type: event type, e.g. 'component.status'
+        :param data: event fields
+        """
+        data.update(time=time.time(), type=type)
+        self.logger.info(json.dumps(data, sort_keys=True, default=str))
+
+    def close(self):
+        for handler in list(self.logger.handlers):
+            handler.close()
+            self.logger.removeHandler(handler)
@@ -0,0 +1,214 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+def sd_notify(state):
+    """Send state to systemd if the daemon was started by it
+
+    :param state: string like 'READY=1' or 'WATCHDOG=1'
+    :return: boolean
+    """
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return False
+    if address.startswith('@'):
+        address = '\0' + address[1:]
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.connect(address)
+        sock.sendall(state.encode('utf-8'))
+    except socket.error as e:
+        logging.warning('Can not notify systemd: {}'.format(e))
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+class Health:
+    def __init__(self, stuck_timeout=90):
+        """Heartbeats and cycle lag of worker threads
+
+        Worker is stuck if its thread is dead or it did not make any
+        progress (HTTP response or finished cycle) for stuck_timeout
+        while it was busy. A worker which is slow but keeps making
+        progress is only reported as falling behind.
+        :param stuck_timeout: seconds, should be above request timeout
+        """
+        self.stuck_timeout = stuck_timeout
+        self.lock = threading.Lock()
+        self.workers = {}
+        self.threads = {}
+
+    def register(self, name, interval, thread=None):
+        """Start tracking of worker
+
+        :param name: thread name, string
+        :param interval: expected seconds between beats
+        :param thread: Thread object, default is the current one
+        """
+        now = time.time()
+        with self.lock:
+            self.workers[name] = {
+                'interval': interval,
+                'last_beat': now,
+                'deadline': now + self.stuck_timeout,
+                'lag': 0,
+                'cycles': 0,
+            }
+            self.threads[name] = thread or threading.current_thread()
+
+    def unregister(self, name):
+        with self.lock:
+            self.workers.pop(name, None)
+            self.threads.pop(name, None)
+
+    def progress(self, name=None):
+        """Mark that worker is busy but alive
+
+        :param name: thread name, default is the current thread
+        """
+        name = name or threading.current_thread().name
+        with self.lock:
+            worker = self.workers.get(name)
+            if worker is not None:
+                worker['deadline'] = time.time() + self.stuck_timeout
+
+    def request_hook(self, response, *args, **kwargs):
+        """requests response hook, every response is a progress"""
+        self.progress()
+
+    def idle(self, name, seconds):
+        """Mark that worker is going to wait without any progress
+
+        :param name: thread name, string
+        :param seconds: how long it is going to wait
+        """
+        with self.lock:
+            worker = self.workers.get(name)
+            if worker is not None:
+                worker['deadline'] = \
+                    time.time() + seconds + self.stuck_timeout
+
+    def beat(self, name, lag=None):
+        """Mark that worker has finished one more cycle
+
+        :param name: thread name, string
+        :param lag: how late the cycle was, seconds.
+                    Default is delay against configured interval
+        """
+        now = time.time()
+        with self.lock:
+            worker = self.workers.get(name)
+            if worker is None:
+                return
+            if lag is None:
+                lag = max(0, now - worker['last_beat'] - worker['interval'])
+            worker['last_beat'] = now
+            worker['deadline'] = now + self.stuck_timeout
+            worker['lag'] = lag
+            worker['cycles'] += 1
+            interval = worker['interval']
+        if lag > interval:
+            logging.warning('{} is falling behind for {:.1f}s'.format(
+                name, lag))
+
+    def status(self):
+        """Return state of all workers
+
+        :return: tuple (healthy, dict)
+        """
+        now = time.time()
+        healthy = True
+        workers = {}
+        with self.lock:
+            for name, worker in self.workers.items():
+                alive = self.threads[name].is_alive()
+                stale = not alive or now > worker['deadline']
+                healthy = healthy and not stale
+                workers[name] = dict(worker, age=now - worker['last_beat'],
+                                     alive=alive, stale=stale)
+        return healthy, workers
+
+
+class Watchdog(threading.Thread):
+    def __init__(self, health, interval=5, exit_on_stale=True):
+        """Ping systemd watchdog while all workers are alive
+
+        :param health: Health object
+        :param interval: seconds between checks
+        :param exit_on_stale: exit the process if a worker is stale,
+                              so supervisor could restart it
+        """
+        super(Watchdog, self).__init__(name='Watchdog')
+        self.daemon = True
+        self.health = health
+        self.interval = interval
+        watchdog_usec = os.environ.get('WATCHDOG_USEC')
+        if watchdog_usec:
+            self.interval = min(interval, int(watchdog_usec) / 2e6)
+        self.exit_on_stale = exit_on_stale
+
+    def run(self):
+        while True:
+            healthy, workers = self.health.status()
+            if healthy:
+                sd_notify('WATCHDOG=1')
+            else:
+                stale = [name for name, i in workers.items() if i['stale']]
+                logging.error('Workers {} are stuck'.format(', '.join(stale)))
+                if self.exit_on_stale:
+                    logging.error('Exit to be restarted by supervisor')
+                    os._exit(1)
+            time.sleep(self.interval)
+
+
+class HealthServer(threading.Thread):
+    def __init__(self, health, port, host='127.0.0.1', actions=None):
+        """Local HTTP endpoint with health status
+
+        GET /health returns status of workers (503 if some is stale).
+        POST to a path from actions calls it.
+        :param health: Health object
+        :param port: int
+        :param host: string
+        :param actions: dict of path: callable
+        """
+        super(HealthServer, self).__init__(name='Health Server')
+        self.daemon = True
+        actions = actions or {}
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, code, data):
+                body = json.dumps(data, indent=2).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path != '/health':
+                    return self._reply(404, {'error': 'not found'})
+                healthy, workers = health.status()
+                self._reply(200 if healthy else 503,
+                            {'healthy': healthy, 'workers': workers})
+
+            def do_POST(self):
+                if self.path not in actions:
+                    return self._reply(404, {'error': 'not found'})
+                self._reply(200, {'result': actions[self.path]()})
+
+            def log_message(self, format, *args):
+                logging.debug('Health server: ' + format % args)
+
+        self.server = HTTPServer((host, port), Handler)
+
+    def run(self):
+        self.server.serve_forever()
@@ -0,0 +1,132 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+class Outbox:
+    def __init__(self, path, max_attempts=5):
+        """Persistent queue of pending Cachet writes
+
+        Writes with the same key are merged and moved to the end of queue,
+        so only the latest state of a component or incident is kept while
+        Cachet is unavailable and states are applied in order.
+        :param path: path to sqlite database, string
+        :param max_attempts: how many times a write could be rejected
+                             by Cachet with 5xx before it is dropped
+        """
+        self.path = path
+        self.max_attempts = max_attempts
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS outbox ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'key TEXT UNIQUE, method TEXT, params TEXT, '
+                'attempts INTEGER DEFAULT 0)'
+            )
+
+    def put(self, key, method, params):
+        """Add write to the queue or merge it into pending one with same key
+
+        :param key: string
+        :param method: name of Cachet method, string
+        :param params: dict
+        """
+        with self.lock, self.db:
+            row = self.db.execute(
+                'SELECT id, params FROM outbox WHERE key = ?', (key,)
+            ).fetchone()
+            if row:
+                merged = json.loads(row[1])
+                merged.update(params)
+                params = merged
+                self.db.execute('DELETE FROM outbox WHERE id = ?', (row[0],))
+            self.db.execute(
+                'INSERT INTO outbox (key, method, params) VALUES (?, ?, ?)',
+                (key, method, json.dumps(params))
+            )
+
+    def items(self):
+        """Return pending writes in order of arrival
+
+        :return: list of tuples (id, method, params)
+        """
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT id, method, params FROM outbox ORDER BY id'
+            ).fetchall()
+        return [(row[0], row[1], json.loads(row[2])) for row in rows]
+
+    def failed(self, id):
+        """Count failed attempt to send write
+
+        :return: number of failed attempts, int
+        """
+        with self.lock, self.db:
+            self.db.execute(
+                'UPDATE outbox SET attempts = attempts + 1 WHERE id = ?', (id,)
+            )
+            return self.db.execute(
+                'SELECT attempts FROM outbox WHERE id = ?', (id,)
+            ).fetchone()[0]
+
+    def delete(self, id):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM outbox WHERE id = ?', (id,))
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+
+
+class CircuitBreaker:
+    def __init__(self, threshold=3, reset_timeout=30):
+        """Stop sending requests after several failures in a row
+
+        When open, one probe request is allowed every reset_timeout seconds.
+        :param threshold: failures in a row to open circuit, int
+        :param reset_timeout: seconds between probes, int
+        """
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened = None
+
+    def allow(self):
+        """Check if a request could be sent now
+
+        :return: boolean
+        """
+        with self.lock:
+            if self.opened is None:
+                return True
+            if time.time() - self.opened >= self.reset_timeout:
+                # Half-open: let one probe through
+                self.opened = time.time()
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            if self.opened is not None:
+                logging.info('Cachet is available again, circuit closed')
+            self.failures = 0
+            self.opened = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold and self.opened is None:
+                logging.warning('Cachet failed {} times in a row, circuit '
+                                'opened for {}s'.format(self.failures,
+                                                        self.reset_timeout))
+            if self.failures >= self.threshold:
+                self.opened = time.time()
@@ -0,0 +1,210 @@
+import cProfile
+import collections
+import contextlib
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+
+def dump_stacks():
+    """Return current stacks of all running threads
+
+    :return: string
+    """
+    names = dict((t.ident, t.name) for t in threading.enumerate())
+    lines = []
+    for ident, frame in sys._current_frames().items():
+        lines.append('Thread {} ({}):\n'.format(names.get(ident, '?'), ident))
+        lines.extend(traceback.format_stack(frame))
+        lines.append('\n')
+    return ''.join(lines)
+
+
+def _fold_stack(frame):
+    """Return stack of frame in collapsed (flamegraph) format
+
+    :param frame: frame object
+    :return: string like "module:func;module:func"
+    """
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('{}:{}:{}'.format(
+            os.path.basename(code.co_filename), code.co_name, code.co_firstlineno
+        ))
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+class Sampler(threading.Thread):
+    """Sample stacks of one thread with fixed interval"""
+    def __init__(self, ident, interval=0.01):
+        super(Sampler, self).__init__(name='Profiler Sampler')
+        self.daemon = True
+        self.ident_target = ident
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.active = threading.Event()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.active.wait(self.interval)
+            if not self.active.is_set():
+                continue
+            frame = sys._current_frames().get(self.ident_target)
+            if frame is not None:
+                self.stacks[_fold_stack(frame)] += 1
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.active.set()
+        self.join()
+
+
+class Profiler:
+    def __init__(self, output_dir, cycles=1, threads=()):
+        """Profile the next N cycles of worker threads on demand
+
+        cProfile could be active only in one thread at once, other
+        threads are profiled by the stack sampler only.
+        :param output_dir: directory for pstats and stacks, string
+        :param cycles: how many cycles to profile after request, int
+        :param threads: names of threads which could be profiled
+        """
+        self.output_dir = output_dir
+        self.cycles = cycles
+        self.threads = threads
+        self.lock = threading.Lock()
+        self.remaining = {}
+        self.sessions = {}
+        self.cprofile_owner = None
+        # Signal handler only sets this event, work is done in a thread
+        self.signalled = threading.Event()
+        self.signal_t = threading.Thread(
+            name='Profiler Signal', target=self._signal_worker
+        )
+        self.signal_t.daemon = True
+        self.signal_t.start()
+
+    def _path(self, prefix, suffix):
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+        return os.path.join(self.output_dir, '{}-{}.{}'.format(
+            prefix.replace(' ', '_'), time.strftime('%Y%m%d-%H%M%S'), suffix
+        ))
+
+    def request(self, cycles=None):
+        """Arm profiling of the next cycles for every watched thread
+
+        :param cycles: int, default is the configured value
+        """
+        cycles = cycles or self.cycles
+        with self.lock:
+            for name in self.threads:
+                self.remaining[name] = cycles
+        logging.info('Profiling of next {} cycles was requested'.format(cycles))
+
+    def dump_stacks(self):
+        """Write stacks of all threads to log and output directory
+
+        :return: path to file, string
+        """
+        stacks = dump_stacks()
+        path = self._path('stacks', 'txt')
+        with open(path, 'w') as f:
+            f.write(stacks)
+        logging.info('Thread stacks were dumped to {}\n{}'.format(path, stacks))
+        return path
+
+    def handle_signal(self, signum, frame):
+        """Signal handler: dump stacks and arm profiling in a thread"""
+        self.signalled.set()
+
+    def _signal_worker(self):
+        while True:
+            self.signalled.wait()
+            self.signalled.clear()
+            try:
+                self.dump_stacks()
+                self.request()
+            except Exception as e:
+                logging.error('Can not start profiling: {}'.format(e))
+
+    def _start(self, name):
+        """Create profiling session for thread
+
+        :return: tuple (cProfile.Profile or None, Sampler)
+        """
+        profile = None
+        with self.lock:
+            if self.cprofile_owner is None:
+                self.cprofile_owner = name
+                profile = cProfile.Profile()
+        sampler = Sampler(threading.current_thread().ident)
+        sampler.start()
+        return profile, sampler
+
+    @contextlib.contextmanager
+    def cycle(self):
+        """Wrap one cycle of the current thread with cProfile and sampler
+        if profiling was requested for it
+        """
+        name = threading.current_thread().name
+        with self.lock:
+            active = self.remaining.get(name, 0) > 0
+        if not active:
+            yield
+            return
+        session = self.sessions.get(name)
+        if session is None:
+            session = self.sessions[name] = self._start(name)
+        profile, sampler = session
+        sampler.active.set()
+        if profile is not None:
+            try:
+                profile.enable()
+            except ValueError as e:
+                # Another profiler is active (Python 3.12+)
+                logging.warning('cProfile is not available for {}: {}. '
+                                'Only stacks will be sampled'.format(name, e))
+                profile = None
+                self.sessions[name] = (None, sampler)
+                self._release(name)
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            sampler.active.clear()
+            with self.lock:
+                self.remaining[name] -= 1
+                done = self.remaining[name] <= 0
+            if done:
+                self._finish(name)
+
+    def _release(self, name):
+        with self.lock:
+            if self.cprofile_owner == name:
+                self.cprofile_owner = None
+
+    def _finish(self, name):
+        profile, sampler = self.sessions.pop(name)
+        sampler.stop()
+        paths = []
+        if profile is not None:
+            self._release(name)
+            pstats_path = self._path(name, 'pstats')
+            profile.dump_stats(pstats_path)
+            paths.append(pstats_path)
+        folded_path = self._path(name, 'folded')
+        with open(folded_path, 'w') as f:
+            for stack, count in sampler.stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
+        paths.append(folded_path)
+        logging.info('Profile of {} was saved to {}'.format(
+            name, ' and '.join(paths)))
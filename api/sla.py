@@ -0,0 +1,210 @@
+import threading
+import time
+
+
+# Length of SLA windows in seconds, 'interval' is set by metric interval
+WINDOWS = {
+    'day': 86400,
+    'week': 604800,
+    'month': 2592000,
+}
+
+# Zabbix service status calculation algorithm
+ALGORITHM_NONE = '0'
+ALGORITHM_ANY = '1'
+ALGORITHM_ALL = '2'
+
+
+def merge(intervals):
+    """Union of intervals
+
+    :param intervals: list of (start, end)
+    :return: sorted list of non overlapping (start, end)
+    """
+    result = []
+    for start, end in sorted(intervals):
+        if result and start <= result[-1][1]:
+            if end > result[-1][1]:
+                result[-1] = (result[-1][0], end)
+        else:
+            result.append((start, end))
+    return result
+
+
+def intersect(a, b):
+    """Intersection of two sorted lists of non overlapping intervals
+
+    :param a: list of (start, end)
+    :param b: list of (start, end)
+    :return: list of (start, end)
+    """
+    result = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        start = max(a[i][0], b[j][0])
+        end = min(a[i][1], b[j][1])
+        if start < end:
+            result.append((start, end))
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return result
+
+
+def overlap(intervals, time_from, time_to):
+    """Total length of intervals inside [time_from, time_to]
+
+    :param intervals: list of non overlapping (start, end)
+    :return: seconds, float
+    """
+    total = 0
+    for start, end in intervals:
+        total += max(0, min(end, time_to) - max(start, time_from))
+    return total
+
+
+class SlaEngine:
+    def __init__(self, anchor_interval=3600):
+        """Compute uptime of Zabbix services from trigger states seen locally
+
+        Problem intervals are taken from trigger 'lastchange' on every check.
+        Periodically SLA is re-anchored with service.getsla, so that windows
+        longer than local history stay correct.
+        :param anchor_interval: how often to call service.getsla, seconds
+        """
+        self.anchor_interval = anchor_interval
+        self.lock = threading.Lock()
+        self.since = time.time()
+        self.anchored = 0
+        # triggerid: list of [start, end], end is None while problem lasts
+        self.problems = {}
+        # triggerid: when trigger was last seen in problem state
+        self.seen = {}
+        # serviceid: (algorithm, list of triggerids)
+        self.services = {}
+        # triggerids of all registered services
+        self.triggerids = set()
+        # (serviceid, window): (time_to, downtime)
+        self.anchors = {}
+
+    def set_services(self, services):
+        """Replace all registered services, e.g. on resync
+
+        History of triggers and anchors of services which are
+        not registered anymore are dropped.
+        :param services: dict of serviceid: (algorithm, triggerids)
+        """
+        with self.lock:
+            self.services = dict(
+                (serviceid, (str(algorithm), list(triggerids)))
+                for serviceid, (algorithm, triggerids) in services.items()
+            )
+            self.triggerids = set(i for _, ids in self.services.values()
+                                  for i in ids)
+            for triggerid in list(self.problems):
+                if triggerid not in self.triggerids:
+                    del self.problems[triggerid]
+                    self.seen.pop(triggerid, None)
+            for key in list(self.anchors):
+                if key[0] not in self.services:
+                    del self.anchors[key]
+
+    def observe(self, trigger):
+        """Register current state of trigger
+
+        :param trigger: dict with triggerid, value and lastchange
+        """
+        clock = int(trigger['lastchange'])
+        with self.lock:
+            if trigger['triggerid'] not in self.triggerids:
+                # Trigger does not define status of any service
+                return
+            problems = self.problems.setdefault(trigger['triggerid'], [])
+            ongoing = problems and problems[-1][1] is None
+            if str(trigger['value']) == '1' and ongoing \
+                    and clock > problems[-1][0]:
+                # Trigger recovered and failed again between checks,
+                # recovery time is unknown, so the last check is used
+                seen = self.seen.get(trigger['triggerid'], problems[-1][0])
+                problems[-1][1] = min(max(seen, problems[-1][0]), clock)
+                ongoing = False
+            if str(trigger['value']) == '1' and not ongoing:
+                problems.append([clock, None])
+            elif str(trigger['value']) == '0' and ongoing:
+                problems[-1][1] = max(clock, problems[-1][0])
+            if str(trigger['value']) == '1':
+                self.seen[trigger['triggerid']] = time.time()
+            # Forget problems which are out of the longest window
+            edge = time.time() - max(WINDOWS.values())
+            while problems and problems[0][1] is not None \
+                    and problems[0][1] < edge:
+                problems.pop(0)
+
+    def needs_anchor(self, now=None):
+        now = now or time.time()
+        return now - self.anchored >= self.anchor_interval
+
+    def anchor(self, serviceid, length, sla, time_to):
+        """Save SLA calculated by Zabbix as base for window
+
+        :param serviceid: string
+        :param length: window length in seconds
+        :param sla: percent, float
+        :param time_to: end of window, timestamp
+        """
+        with self.lock:
+            self.anchors[(serviceid, length)] = (
+                time_to, (100 - float(sla)) / 100 * length
+            )
+            self.anchored = time_to
+
+    def _service_problems(self, serviceid, now):
+        algorithm, triggerids = self.services.get(serviceid, (None, []))
+        children = [
+            merge([(start, end if end is not None else now)
+                   for start, end in self.problems.get(triggerid, [])])
+            for triggerid in triggerids
+        ]
+        if algorithm == ALGORITHM_ANY:
+            return merge([i for child in children for i in child])
+        if algorithm == ALGORITHM_ALL and children:
+            result = children[0]
+            for child in children[1:]:
+                result = intersect(result, child)
+            return result
+        return []
+
+    def uptime(self, serviceid, length, now=None):
+        """Uptime of service in window [now - length, now]
+
+        :param serviceid: string
+        :param length: window length in seconds
+        :param now: end of window, timestamp
+        :return: percent, float
+        """
+        now = now or time.time()
+        time_from = now - length
+        with self.lock:
+            problems = self._service_problems(serviceid, now)
+            anchor = self.anchors.get((serviceid, length))
+        if anchor is None:
+            # Only local history is known
+            known_from = max(time_from, self.since)
+            if now <= known_from:
+                return 100.0
+            downtime = overlap(problems, known_from, now)
+            return 100.0 * (1 - downtime / (now - known_from))
+        anchor_to, downtime = anchor
+        anchor_from = anchor_to - length
+        # Add what happened after anchor
+        downtime += overlap(problems, anchor_to, now)
+        # and subtract part which slid out of the window.
+        # Assume uniform downtime in part older than local history
+        known_from = max(anchor_from, self.since)
+        if time_from > known_from:
+            downtime -= overlap(problems, known_from, time_from)
+        unknown = max(0, min(time_from, self.since) - anchor_from)
+        downtime -= anchor[1] * unknown / length
+        downtime = min(max(downtime, 0), length)
+        return 100.0 * (1 - downtime / length)
@@ -0,0 +1,93 @@
+import gc
+import logging
+import os
+import resource
+import tracemalloc
+
+
+def rss():
+    """Return resident memory of current process in bytes"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        # Peak RSS, in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class SoakMonitor:
+    def __init__(self, rss_budget, traced_budget, objects_budget,
+                 warmup=10, top=10):
+        """Track memory and allocations growth over many cycles
+
+        Growth is measured against the state after warmup cycles,
+        when caches and connection pools are already filled.
+        :param rss_budget: allowed RSS growth, MB
+        :param traced_budget: allowed growth of memory traced by
+                              tracemalloc, MB
+        :param objects_budget: allowed growth of gc tracked objects
+        :param warmup: number of cycles before baseline, int
+        :param top: number of top allocators to report, int
+        """
+        self.rss_budget = rss_budget * 1024 * 1024
+        self.traced_budget = traced_budget * 1024 * 1024
+        self.objects_budget = objects_budget
+        self.warmup = warmup
+        self.top = top
+        self.samples = []
+        self.baseline = None
+        self.snapshot = None
+        tracemalloc.start()
+
+    def sample(self, cycle):
+        """Record state after cycle
+
+        :param cycle: number of cycle, int
+        """
+        gc.collect()
+        sample = {
+            'cycle': cycle,
+            'rss': rss(),
+            'traced': tracemalloc.get_traced_memory()[0],
+            'objects': len(gc.get_objects()),
+        }
+        self.samples.append(sample)
+        if cycle == self.warmup:
+            self.baseline = sample
+            self.snapshot = tracemalloc.take_snapshot()
+        logging.info('Soak cycle {cycle}: rss={rss} traced={traced} '
+                     'objects={objects}'.format(**sample))
+
+    def top_allocators(self):
+        """Return lines which allocated most memory since baseline
+
+        :return: list of strings
+        """
+        snapshot = tracemalloc.take_snapshot()
+        if self.snapshot is None:
+            stats = snapshot.statistics('lineno')
+        else:
+            stats = snapshot.compare_to(self.snapshot, 'lineno')
+        return [str(stat) for stat in stats[:self.top]]
+
+    def check(self):
+        """Compare growth since baseline with budgets
+
+        :return: list of exceeded budgets, empty if everything is fine
+        """
+        for line in self.top_allocators():
+            logging.info('Top allocator: {}'.format(line))
+        if self.baseline is None or self.samples[-1]['cycle'] <= self.warmup:
+            return ['not enough cycles to get past {} warmup cycles'.format(
+                self.warmup)]
+        last = self.samples[-1]
+        errors = []
+        for key, budget in (('rss', self.rss_budget),
+                            ('traced', self.traced_budget),
+                            ('objects', self.objects_budget)):
+            growth = last[key] - self.baseline[key]
+            logging.info('Soak {} growth: {}'.format(key, growth))
+            if growth > budget:
+                errors.append('{} grew by {} over budget {}'.format(
+                    key, growth, budget))
+        return errors
@@ -0,0 +1,179 @@
+import gzip
+import json
+import logging
+import threading
+from collections import defaultdict, deque
+
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+
+def _decode_body(body):
+    """Convert request body to text
+
+    :param body: bytes or string or None
+    :return: string
+    """
+    if body is None:
+        return ''
+    if isinstance(body, bytes):
+        return body.decode('utf-8', 'replace')
+    return body
+
+
+def request_key(method, url, body):
+    """Build a key which identifies the same request between runs
+
+    Zabbix JSON-RPC requests carry an incremental id and an auth token
+    which differ on every run, so they are dropped from the key.
+    Credentials of user.login are dropped as well to keep them out of traces.
+    :param method: HTTP method, string
+    :param url: string
+    :param body: request body, string
+    :return: tuple (exact key, loose key, normalized body)
+    """
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        payload = None
+    if isinstance(payload, dict) and 'jsonrpc' in payload:
+        payload.pop('id', None)
+        payload.pop('auth', None)
+        if payload.get('method') == 'user.login':
+            payload['params'] = {}
+        body = json.dumps(payload, sort_keys=True)
+        loose = (method, url, payload.get('method'))
+    else:
+        loose = (method, url.split('?', 1)[0])
+    return (method, url, body), loose, body
+
+
+def scrub_response(body, text):
+    """Replace Zabbix session token in user.login response
+
+    :param body: normalized request body, string
+    :param text: response body, string
+    :return: string
+    """
+    try:
+        payload = json.loads(body)
+        response = json.loads(text)
+    except ValueError:
+        return text
+    if isinstance(payload, dict) and payload.get('method') == 'user.login' \
+            and isinstance(response, dict) and 'result' in response:
+        response['result'] = 'trace-token'
+        return json.dumps(response)
+    return text
+
+
+class TraceRecorder(HTTPAdapter):
+    """Transport adapter which writes every request and response
+    to a gzip compressed JSONL trace
+    """
+    def __init__(self, path, **kwargs):
+        super(TraceRecorder, self).__init__(**kwargs)
+        self.path = path
+        self.lock = threading.Lock()
+        self.trace = gzip.open(path, 'at')
+
+    def send(self, request, **kwargs):
+        response = super(TraceRecorder, self).send(request, **kwargs)
+        body = request_key(request.method, request.url,
+                           _decode_body(request.body))[2]
+        record = {
+            'method': request.method,
+            'url': request.url,
+            'body': body,
+            'status': response.status_code,
+            'headers': {'Content-Type': response.headers.get('Content-Type')},
+            'response': scrub_response(body, response.text),
+        }
+        with self.lock:
+            self.trace.write(json.dumps(record) + '\n')
+            self.trace.flush()
+        return response
+
+    def close(self):
+        super(TraceRecorder, self).close()
+        with self.lock:
+            self.trace.close()
+
+
+class TraceReplayer(BaseAdapter):
+    """Transport adapter which serves responses from a trace
+    recorded by TraceRecorder without touching the network.
+
+    Requests are matched by method, url and body first and by
+    method and url (JSON-RPC method for Zabbix) if nothing was found.
+    Responses for the same key are served in recorded order,
+    the last one is repeated once the queue is exhausted.
+    """
+    def __init__(self, path):
+        super(TraceReplayer, self).__init__()
+        self.path = path
+        self.lock = threading.Lock()
+        self.exact = defaultdict(deque)
+        self.loose = defaultdict(deque)
+        with gzip.open(path, 'rt') as trace:
+            for line in trace:
+                record = json.loads(line)
+                exact, loose, _ = request_key(
+                    record['method'], record['url'], record['body'])
+                self.exact[exact].append(record)
+                self.loose[loose].append(record)
+        logging.info('Loaded {} requests from trace {}'.format(
+            sum(len(i) for i in self.exact.values()), path))
+
+    @staticmethod
+    def _pop(queue):
+        if len(queue) > 1:
+            return queue.popleft()
+        return queue[0]
+
+    def send(self, request, **kwargs):
+        exact, loose, _ = request_key(request.method, request.url,
+                                      _decode_body(request.body))
+        with self.lock:
+            if self.exact.get(exact):
+                record = self._pop(self.exact[exact])
+            elif self.loose.get(loose):
+                record = self._pop(self.loose[loose])
+            else:
+                record = None
+        response = Response()
+        response.request = request
+        response.url = request.url
+        response.encoding = 'utf-8'
+        if record is None:
+            logging.warning('Trace has no response for {} {}'.format(
+                request.method, request.url))
+            response.status_code = 404
+            response.headers = CaseInsensitiveDict(
+                {'Content-Type': 'application/json'})
+            response._content = json.dumps(
+                {'errors': ['Not found in trace']}).encode('utf-8')
+            return response
+        response.status_code = record['status']
+        response.headers = CaseInsensitiveDict(
+            dict((k, v) for k, v in record['headers'].items() if v))
+        response._content = record['response'].encode('utf-8')
+        return response
+
+    def close(self):
+        pass
+
+
+def trace_adapter(mode, path):
+    """Return transport adapter for trace mode
+
+    :param mode: 'record' or 'replay'
+    :param path: path to trace file, string
+    :return: adapter object
+    """
+    if mode == 'record':
+        return TraceRecorder(path)
+    if mode == 'replay':
+        return TraceReplayer(path)
+    raise ValueError('Unknown trace mode "{}"'.format(mode))
@@ -1,55 +1,119 @@
+import logging
+import sys
+import threading
+
 import requests
 
-from pyzabbix import ZabbixAPI
+from pyzabbix import ZabbixAPI, ZabbixAPIException
+
+
+# Only fields which are used by zabbix-cachet
+TRIGGER_FIELDS = ['triggerid', 'description', 'priority', 'value', 'url',
+                  'lastchange']
+EVENT_FIELDS = ['eventid', 'acknowledged', 'clock']
+ACKNOWLEDGE_FIELDS = ['clock', 'message', 'alias', 'name', 'surname']
+SERVICE_FIELDS = ['serviceid', 'name', 'sortorder', 'triggerid', 'algorithm',
+                  'showsla']
+
+# Errors which mean that auth token is not valid anymore
+SESSION_ERRORS = ('Session terminated', 'Not authorised', 'Not authorized')
 
 
 class Zabbix:
-    def __init__(self, server, user, password, verify=True):
+    def __init__(self, server, user, password, verify=True, adapter=None,
+                 timeout=30):
         """Init Zabbix class for further needs
 
         :param user: string
         :param password: string
+        :param adapter: requests transport adapter (e.g. trace recorder)
+        :param timeout: HTTP request timeout in seconds
         :return: pyzabbix object
         """
         self.server = server
         self.user = user
         self.password = password
+        self.login_lock = threading.Lock()
 
         # Enable HTTP auth
         session = requests.Session()
         session.auth = (user, password)
+        session.headers.update({'Accept-Encoding': 'gzip'})
+        if adapter is not None:
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
 
-        self.zapi = ZabbixAPI(server, session)
+        self.zapi = ZabbixAPI(server, session, timeout=timeout)
         self.zapi.session.verify = verify
         self.zapi.login(user, password)
 
+    def _request(self, method, **params):
+        """Call Zabbix API method with the current auth token.
+        Login again once if Zabbix session has expired.
+        Only one thread logs in, the rest retry with its token.
+
+        @param method: string, e.g. 'trigger.get'
+        @param params: method params
+        @return: result of method
+        """
+        auth = self.zapi.auth
+        try:
+            return self.zapi.do_request(method, params)['result']
+        except ZabbixAPIException as e:
+            if not any(error in str(e) for error in SESSION_ERRORS):
+                raise
+            with self.login_lock:
+                if self.zapi.auth == auth:
+                    logging.info('Zabbix session has expired. Login again')
+                    self.zapi.login(self.user, self.password)
+            return self.zapi.do_request(method, params)['result']
+
     def get_trigger(self, triggerid):
         """Get trigger information
 
         @param triggerid: string
         @return: dict of data
         """
-        trigger = self.zapi.trigger.get(
-            expandComment='true',
+        trigger = self._request(
+            'trigger.get',
+            output=TRIGGER_FIELDS,
             expandDescription='true',
             triggerids=triggerid)
         return trigger[0]
 
+    def get_triggers(self, triggerids):
+        """Get information of several triggers in one request
+
+        @param triggerids: list of strings
+        @return: dict of data with triggerid as a key
+        """
+        triggers = self._request(
+            'trigger.get',
+            output=TRIGGER_FIELDS,
+            expandDescription='true',
+            triggerids=triggerids)
+        return dict((trigger['triggerid'], trigger) for trigger in triggers)
+
     def get_event(self, triggerid):
-        """Get event information based on triggerid
+        """Get last problem event based on triggerid
 
         @param triggerid: string
-        @return: dict of data
+        @return: dict of data, empty if there is no event
         """
-        zbx_event = self.zapi.event.get(
-            select_acknowledges='extend',
-            expandDescription='true',
+        zbx_event = self._request(
+            'event.get',
+            output=EVENT_FIELDS,
+            select_acknowledges=ACKNOWLEDGE_FIELDS,
             object=0,
             value=1,
-            objectids=triggerid)
-        if len(zbx_event) > 1:
-            return zbx_event[-1]
-        return zbx_event
+            objectids=triggerid,
+            sortfield=['clock', 'eventid'],
+            sortorder='DESC',
+            limit=1)
+        try:
+            return zbx_event[0]
+        except IndexError:
+            return {}
 
     def get_itservice_by_name(self, trigger_name):
         """Get IT Service by name
@@ -60,7 +124,9 @@ class Zabbix:
         Returns:
             Dict: IT Service object
         """
-        service = self.zapi.service.get(
+        service = self._request(
+            'service.get',
+            output=SERVICE_FIELDS,
             filter={'name': trigger_name}
         )
         try:
@@ -83,7 +149,9 @@ class Zabbix:
         :return: Tree of Zabbix IT Services, List
         """
         if root:
-            root_service = self.zapi.service.get(
+            root_service = self._request(
+                'service.get',
+                output=['serviceid'],
                 selectDependencies='extend',
                 filter={'name': root}
             )
@@ -98,26 +166,37 @@ class Zabbix:
             service_ids = []
             for dependency in root_service['dependencies']:
                 service_ids.append(dependency['serviceid'])
-            services = self.zapi.service.get(
+            services = self._request(
+                'service.get',
+                output=SERVICE_FIELDS,
                 selectDependencies='extend',
                 serviceids=service_ids)
         else:
-            services = self.zapi.service.get(
-                selectDependencies='extend',
-                output='extend')
+            services = self._request(
+                'service.get',
+                output=SERVICE_FIELDS,
+                selectDependencies='extend')
         if not services:
             logging.error(
                 'Can not find any child service for "{}"'.format(root)
             )
             return []
-        for idx, service in enumerate(services):
-            child_services = []
+        # Get child services of all services in one request
+        child_ids = set()
+        for service in services:
             for dependency in service['dependencies']:
-                child_services.append(dependency['serviceid'])
-            child_services = self.zapi.service.get(
-                    selectDependencies='extend',
-                    serviceids=child_services)
-            services[idx]['dependencies'] = child_services
+                child_ids.add(dependency['serviceid'])
+        child_services = []
+        if child_ids:
+            child_services = self._request(
+                'service.get',
+                output=SERVICE_FIELDS,
+                serviceids=list(child_ids))
+        for service in services:
+            dependencies = set(i['serviceid'] for i in service['dependencies'])
+            service['dependencies'] = [
+                i for i in child_services if i['serviceid'] in dependencies
+            ]
         return services
 
     def get_sla(self, serviceids, time_from, time_to):
@@ -130,7 +209,8 @@ class Zabbix:
         Returns:
             dict: object with info about SLA time
         """
-        result = self.zapi.service.getsla(
+        result = self._request(
+            'service.getsla',
             serviceids=serviceids,
             intervals={
                 'from': time_from,
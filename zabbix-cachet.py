@@ -8,10 +8,19 @@ import datetime
 import time
 import threading
 import logging
+import signal
 import yaml
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from api.zabbix import Zabbix
-from api.cachet import Cachet
+from api.cachet import Cachet, CachetHttpError
+from api.outbox import Outbox, CircuitBreaker
+from api.trace import trace_adapter
+from api.profiler import Profiler
+from api.sla import SlaEngine, WINDOWS
+from api.health import Health, HealthServer, Watchdog, sd_notify
+from api.soak import SoakMonitor
+from api.events import EventStream
 
 __author__ = 'Artem Alexandrov <qk4l()tem4uk.ru>'
 __license__ = """The MIT License (MIT)"""
@@ -57,6 +66,7 @@ def triggers_watcher(service_map):
 
         if 'triggerid' in i:
             trigger = zapi.get_trigger(i['triggerid'])
+            sla.observe(trigger)
             # Check if incident already registered
             # Trigger non Active
             if str(trigger['value']) == '0':
@@ -89,7 +99,7 @@ def triggers_watcher(service_map):
             elif trigger['value'] == '1':
                 zbx_event = zapi.get_event(i['triggerid'])
                 inc_name = trigger['description']
-                if zbx_event['acknowledged'] == '1':
+                if zbx_event.get('acknowledged') == '1':
                     inc_status = 2
                     inc_msg = cachet.get_incident(i['component_id'])['message']
                     for msg in zbx_event['acknowledges']:
@@ -158,49 +168,152 @@ def triggers_watcher(service_map):
     return True
 
 
-def triggers_watcher_worker(service_map, interval, e):
+def poll_interval(item, interval, priority_intervals, group_intervals):
     """
-    Worker for triggers_watcher. Run it continuously with specific interval
+    Return how often component should be checked
+    Group override has precedence over trigger priority
+    @param item: dict from service map
+    @param interval: default interval in seconds
+    @param priority_intervals: dict of Zabbix priority: interval
+    @param group_intervals: dict of group name: interval
+    @return: interval in seconds
+    """
+    if item.get('group_name') in group_intervals:
+        return group_intervals[item['group_name']]
+    if 'priority' in item:
+        return priority_intervals.get(int(item['priority']), interval)
+    return interval
+
+
+def triggers_watcher_worker(service_map, interval, e,
+                            priority_intervals=None, group_intervals=None,
+                            retry_interval=None):
+    """
+    Worker for triggers_watcher. Run it continuously and check every
+    component with its own interval
     @param service_map: list of tuples
-    @param interval: interval in seconds
+    @param interval: default interval in seconds
     @param e: treading.Event object
+    @param priority_intervals: dict of Zabbix priority: interval
+    @param group_intervals: dict of group name: interval
+    @param retry_interval: delay before retry of failed checks,
+                           default interval
     @return:
     """
+    retry_interval = retry_interval or interval
     logging.info('start trigger watcher')
+    intervals = [
+        poll_interval(i, interval, priority_intervals or {},
+                      group_intervals or {})
+        for i in service_map
+    ]
+    next_check = [0] * len(service_map)
+    name = threading.current_thread().name
+    health.register(name, interval)
     while not e.is_set():
-        logging.debug('check Zabbix triggers')
-        triggers_watcher(service_map)
-        time.sleep(interval)
+        now = time.time()
+        due = [idx for idx, check in enumerate(next_check) if check <= now]
+        logging.debug('check {} Zabbix triggers'.format(len(due)))
+        # How late the most overdue component is checked
+        lag = now - min(next_check[idx] for idx in due) \
+            if due and max(next_check) else 0
+        # Checked components are scheduled by their own interval,
+        # failed ones are retried after retry_interval.
+        # The rest of cycle is skipped only if Cachet is unreachable.
+        done = set()
+        try:
+            cachet.flush_outbox()
+            with profiler.cycle():
+                for idx in due:
+                    try:
+                        triggers_watcher([service_map[idx]])
+                    except CachetHttpError as err:
+                        if err.code is None:
+                            raise
+                        logging.warning('Retry check of {} in {}s: {}'.format(
+                            service_map[idx].get('component_id'),
+                            retry_interval, err))
+                        next_check[idx] = time.time() + retry_interval
+                    except Exception:
+                        logging.exception('Check of {} failed'.format(
+                            service_map[idx].get('component_id')))
+                        next_check[idx] = time.time() + retry_interval
+                    else:
+                        next_check[idx] = now + intervals[idx]
+                    done.add(idx)
+        except CachetHttpError as err:
+            logging.warning('Skip triggers check for {}s: {}'.format(
+                retry_interval, err))
+        except Exception:
+            logging.exception('Triggers check failed')
+        for idx in due:
+            if idx not in done:
+                next_check[idx] = time.time() + retry_interval
+        health.beat(name, lag)
+        wait = max(min(next_check or [now + interval]) - time.time(), 1)
+        health.idle(name, wait)
+        e.wait(wait)
+    health.unregister(name)
     logging.info('end trigger watcher')
 
 
-def metrics_updater(metrics_mapping, interval):
-    # Get SLA of current services
+def metrics_updater(metrics_mapping, interval, window='interval'):
+    """
+    Send uptime of services to Cachet metrics
+    Uptime is calculated locally from trigger states, Zabbix SLA is used
+    only to re-anchor it from time to time.
+    @param metrics_mapping: list of dicts
+    @param interval: interval in seconds
+    @param window: name of SLA window which is sent to Cachet
+    @return:
+    """
     service_ids = [service['service_id'] for service in metrics_mapping]
     time_to = time.mktime(datetime.datetime.now().timetuple())
-    time_from = time_to - interval
+    windows = dict(WINDOWS, interval=interval)
 
-    result = zapi.get_sla(service_ids, time_from, time_to)
+    if sla.needs_anchor(time_to):
+        logging.debug('Re-anchor SLA with Zabbix')
+        for length in set(windows.values()):
+            result = zapi.get_sla(service_ids, time_to - length, time_to)
+            for service_id in service_ids:
+                sla.anchor(service_id, length,
+                           result[service_id]['sla'][0]['sla'], time_to)
 
     for service in metrics_mapping:
-        # Get SLA info
-        sla_info = result[service['service_id']]['sla'][0]
+        uptime = dict(
+            (name, sla.uptime(service['service_id'], length, time_to))
+            for name, length in windows.items()
+        )
+        logging.debug('Service {} uptime: {}'.format(
+            service['service_id'], uptime))
 
         # Send as point in Cachet metric
         cachet.add_point_to_metric(
             id=service['metric_id'],
-            value=sla_info['sla'],
-            timestamp=sla_info['to']
+            value=uptime[window],
+            timestamp=int(time_to)
         )
 
     logging.info("SLA was updated.")
 
-def metrics_updater_worker(metrics_mapping, interval, e):
+def metrics_updater_worker(metrics_mapping, interval, window, e):
     logging.info('Start metrics updater')
+    name = threading.current_thread().name
+    health.register(name, interval)
     while not e.is_set():
         logging.debug('Getting SLA of Zabbix services and send to Cachet')
-        metrics_updater(metrics_mapping, interval)
-        time.sleep(interval)
+        try:
+            cachet.flush_outbox()
+            with profiler.cycle():
+                metrics_updater(metrics_mapping, interval, window)
+        except CachetHttpError as err:
+            logging.warning('Skip SLA update: {}'.format(err))
+        except Exception:
+            logging.exception('SLA update failed')
+        health.beat(name)
+        health.idle(name, interval)
+        e.wait(interval)
+    health.unregister(name)
 
 
 def init_metrics(service_names):
@@ -214,11 +327,19 @@ def init_metrics(service_names):
 
     # List of services that should be tracked
     services = []
+    sla_services = {}
     for zbx_service in service_names:
         name = zbx_service['name']
         service = zapi.get_itservice_by_name(name)
         if service:
             services.append(service)
+            # Triggers which define status of service for local SLA
+            triggerids = [i['triggerid'] for i in zbx_service['dependencies']
+                          if int(i['triggerid']) != 0]
+            if zbx_service['triggerid'] and int(zbx_service['triggerid']) != 0:
+                triggerids.append(zbx_service['triggerid'])
+            sla_services[service['serviceid']] = (service['algorithm'],
+                                                  triggerids)
         elif service and service['showsla'] == '0':
             logging.error("Zabbix service with name '{name}' does not setting "
                           "up to show SLA.".format(name=name))
@@ -226,6 +347,7 @@ def init_metrics(service_names):
             logging.error("Zabbix service with name '{name}' does not found! "
                           "Please, check your config"
                           .format(name=name))
+    sla.set_services(sla_services)
 
     # List of all metrics
     metrics = cachet.get_metrics()
@@ -264,70 +386,209 @@ def init_metrics(service_names):
 def get_order(service):
     return int(service['serviceid']) + int(service['sortorder'])*1000
 
-def init_cachet(services):
+def init_cachet(services, concurrency=8):
     """
     Init Cachet by syncing Zabbix service to it
     Also func create mapping batten Cachet components and Zabbix IT services
+    Groups are synced first, then their components in parallel.
     @param services: list
+    @param concurrency: max number of parallel Cachet requests
     @return: list of tuples
     """
-    # Zabbix Triggers to Cachet components id map
-    data = []
+    # Prefetch all triggers in one request
+    triggerids = set()
     for zbx_service in services:
-        # Check if zbx_service has childes
-        zxb2cachet_i = {}
         if zbx_service['dependencies']:
-            group = cachet.new_components_gr(zbx_service['name'], get_order(zbx_service))
             for dependency in zbx_service['dependencies']:
-                # Component without trigger
                 if int(dependency['triggerid']) != 0:
-                    trigger = zapi.get_trigger(dependency['triggerid'])
-                    component = cachet.new_components(
-                        dependency['name'],
-                        group_id=group['id'],
+                    triggerids.add(dependency['triggerid'])
+        elif zbx_service['triggerid'] and int(zbx_service['triggerid']) != 0:
+            triggerids.add(zbx_service['triggerid'])
+    triggers = zapi.get_triggers(list(triggerids)) if triggerids else {}
+
+    # Already registered groups by name and components by (name, group_id).
+    # Pool workers only create what is missing, so they do not scan Cachet
+    groups = {}
+    for group in cachet.paginate('components/groups'):
+        groups.setdefault(group['name'], group)
+    components = {}
+    for component in cachet.get_components():
+        components.setdefault(
+            (component['name'], int(component['group_id'] or 0)), component
+        )
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for zbx_service in services:
+            if zbx_service['dependencies'] and \
+                    zbx_service['name'] not in groups:
+                groups[zbx_service['name']] = executor.submit(
+                    cachet.new_components_gr, zbx_service['name'],
+                    get_order(zbx_service), check_existing=False
+                )
+        for name, group in groups.items():
+            if isinstance(group, Future):
+                groups[name] = group.result()
+                health.progress()
+
+        def sync_component(name, group_id=0, **kwargs):
+            key = (name, int(group_id))
+            if key not in components:
+                components[key] = executor.submit(
+                    cachet.new_components, name, group_id=group_id,
+                    check_existing=False, **kwargs
+                )
+            return components[key]
+
+        # Zabbix Triggers to Cachet components id map
+        # with component which is being synced
+        jobs = []
+        for zbx_service in services:
+            # Check if zbx_service has childes
+            zxb2cachet_i = {}
+            if zbx_service['dependencies']:
+                group = groups[zbx_service['name']]
+                for dependency in zbx_service['dependencies']:
+                    # Component without trigger
+                    if int(dependency['triggerid']) != 0:
+                        trigger = triggers[dependency['triggerid']]
+                        component = sync_component(
+                            dependency['name'],
+                            group_id=group['id'],
+                            link=trigger['url'],
+                            description=trigger['description']
+                        )
+                        # Create a map of Zabbix Trigger <> Cachet IDs
+                        zxb2cachet_i = {'triggerid': dependency['triggerid'],
+                                        'priority': trigger['priority']}
+                    else:
+                        component = sync_component(
+                            dependency['name'],
+                            group_id=group['id']
+                        )
+                        zxb2cachet_i = {'serviceid': dependency['serviceid']}
+
+                    zxb2cachet_i.update({
+                        'group_id': group['id'],
+                        'group_name': group['name'],
+                    })
+                    jobs.append((zxb2cachet_i, component))
+            else:
+                component = None
+                # Component with trigger
+                if zbx_service['triggerid']:
+                    if int(zbx_service['triggerid']) == 0:
+                        logging.debug("Zabbix Service with service name = '{}' "
+                                      " does not have trigger or child service"
+                                      .format(zbx_service['serviceid'])
+                                      )
+                        continue
+                    trigger = triggers[zbx_service['triggerid']]
+                    component = sync_component(
+                        zbx_service['name'],
                         link=trigger['url'],
-                        description=trigger['description']
+                        description=trigger['description'],
+                        order=get_order(zbx_service)
                     )
                     # Create a map of Zabbix Trigger <> Cachet IDs
-                    zxb2cachet_i = {'triggerid': dependency['triggerid']}
-                else:
-                    component = cachet.new_components(
-                        dependency['name'],
-                        group_id=group['id']
-                    )
-                    zxb2cachet_i = {'serviceid': dependency['serviceid']}
-
+                    zxb2cachet_i = {'triggerid': zbx_service['triggerid'],
+                                    'priority': trigger['priority']}
+                jobs.append((zxb2cachet_i, component))
+
+        data = []
+        for zxb2cachet_i, component in jobs:
+            if component is not None:
+                if isinstance(component, Future):
+                    component = component.result()
+                    health.progress()
                 zxb2cachet_i.update({
-                    'group_id': group['id'],
-                    'group_name': group['name'],
                     'component_id': component['id'],
                     'component_name': component['name']
                 })
-                data.append(zxb2cachet_i)
-        else:
-            # Component with trigger
-            if zbx_service['triggerid']:
-                if int(zbx_service['triggerid']) == 0:
-                    logging.debug("Zabbix Service with service name = '{}' "
-                                  " does not have trigger or child service"
-                                  .format(zbx_service['serviceid'])
-                                  )
-                    continue
-                trigger = zapi.get_trigger(zbx_service['triggerid'])
-                component = cachet.new_components(
-                    zbx_service['name'],
-                    link=trigger['url'],
-                    description=trigger['description'],
-                    order=get_order(zbx_service)
-                )
-                # Create a map of Zabbix Trigger <> Cachet IDs
-                zxb2cachet_i = {'triggerid': zbx_service['triggerid'],
-                                'component_id': component['id'],
-                                'component_name': component['name']}
             data.append(zxb2cachet_i)
     return data
 
 
+def replay(root_service, metric_interval, concurrency):
+    """
+    Run one pass of every stage against a recorded trace without sleeping
+    @param root_service: string
+    @param metric_interval: interval in seconds
+    @param concurrency: max number of parallel Cachet requests
+    @return: dict of stage durations
+    """
+    timings = {}
+    start = time.time()
+    itservices = zapi.get_itservices(root_service)
+    zbxtr2cachet = init_cachet(itservices, concurrency)
+    timings['init_cachet'] = time.time() - start
+
+    start = time.time()
+    triggers_watcher(zbxtr2cachet)
+    timings['triggers_watcher'] = time.time() - start
+
+    start = time.time()
+    metrics_mapping = init_metrics(itservices)
+    metrics_updater(metrics_mapping, metric_interval)
+    timings['metrics_updater'] = time.time() - start
+
+    for stage, duration in sorted(timings.items()):
+        logging.info('Replay {}: {:.3f}s'.format(stage, duration))
+    return timings
+
+
+def soak(root_service, metric_interval, concurrency, cycles, monitor):
+    """
+    Run resync loop, triggers_watcher and metrics_updater for many cycles
+    against a recorded trace and check memory growth
+    @param root_service: string
+    @param metric_interval: interval in seconds
+    @param concurrency: max number of parallel Cachet requests
+    @param cycles: number of cycles, int
+    @param monitor: SoakMonitor object
+    @return: list of exceeded budgets
+    """
+    zbxtr2cachet = None
+    metrics_mapping = None
+    for cycle in range(1, cycles + 1):
+        itservices = zapi.get_itservices(root_service)
+        zbxtr2cachet_new = init_cachet(itservices, concurrency)
+        if zbxtr2cachet != zbxtr2cachet_new:
+            zbxtr2cachet = zbxtr2cachet_new
+            metrics_mapping = init_metrics(itservices)
+        # Workers are started in new threads like after resync.
+        # Their exceptions fail the run
+        failures = []
+
+        def run(func, *args):
+            try:
+                func(*args)
+            except Exception as e:
+                logging.exception('Soak cycle {} failed'.format(cycle))
+                failures.append('{}: {!r}'.format(func.__name__, e))
+
+        workers = [
+            threading.Thread(target=run,
+                             args=(triggers_watcher, zbxtr2cachet)),
+            threading.Thread(target=run,
+                             args=(metrics_updater, metrics_mapping,
+                                   metric_interval)),
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if failures:
+            for error in failures:
+                logging.error('Soak test failed: {}'.format(error))
+            return failures
+        cachet.flush_outbox()
+        monitor.sample(cycle)
+    errors = monitor.check()
+    for error in errors:
+        logging.error('Soak test failed: {}'.format(error))
+    return errors
+
+
 def read_config(config_f):
     """
     Read config file
@@ -364,21 +625,107 @@ if __name__ == '__main__':
     inc_update_t = threading.Thread()
     metric_update_t = threading.Thread()
     event = threading.Event()
+
+    # Send SIGUSR1 to dump thread stacks and profile next cycles of workers
+    profiler = Profiler(
+        SETTINGS.get('profile_dir', '/tmp/zabbix-cachet-profile'),
+        SETTINGS.get('profile_cycles', 1),
+        ('Trigger Watcher', 'Metrics Updater')
+    )
+    signal.signal(signal.SIGUSR1, profiler.handle_signal)
+
+    # Heartbeats of workers, systemd watchdog and local health endpoint
+    # Worker is stuck if it did not get any response for a few timeouts
+    health = Health(
+        SETTINGS.get('request_timeout', 30) * SETTINGS.get('stale_factor', 3)
+    )
+    health.register('MainThread', SETTINGS['update_comp_interval'])
+    # HEALTH_PORT is set in Docker image to match its HEALTHCHECK
+    health_port = int(os.environ.get('HEALTH_PORT',
+                                     SETTINGS.get('health_port', 0)))
+    if health_port:
+        HealthServer(
+            health,
+            health_port,
+            actions={
+                '/profile': lambda: profiler.request() or 'requested',
+                '/stacks': profiler.dump_stacks
+            }
+        ).start()
+
+    trace_mode = SETTINGS.get('trace_mode')
+    adapter = None
+    events = None
+    if trace_mode:
+        adapter = trace_adapter(trace_mode, SETTINGS['trace_file'])
+        logging.info('Trace {} mode, file {}'.format(
+            trace_mode, SETTINGS['trace_file']))
     try:
         zapi = Zabbix(
             ZABBIX['server'],
             ZABBIX['user'],
             ZABBIX['pass'],
-            ZABBIX['https-verify']
+            ZABBIX['https-verify'],
+            adapter=adapter,
+            timeout=SETTINGS.get('request_timeout', 30)
         )
-
+        zapi.zapi.session.hooks['response'].append(health.request_hook)
+
+        if SETTINGS.get('events_file'):
+            events = EventStream(
+                SETTINGS['events_file'],
+                SETTINGS.get('events_max_bytes', 10485760),
+                SETTINGS.get('events_backup_count', 5)
+            )
+        outbox = None
+        if SETTINGS.get('outbox_file'):
+            outbox = Outbox(SETTINGS['outbox_file'],
+                            SETTINGS.get('outbox_max_attempts', 5))
         cachet = Cachet(
             CACHET['server'],
             CACHET['token'],
-            CACHET['https-verify']
+            CACHET['https-verify'],
+            adapter=adapter,
+            outbox=outbox,
+            breaker=CircuitBreaker(
+                SETTINGS.get('breaker_threshold', 3),
+                SETTINGS.get('breaker_timeout', 30)
+            ),
+            timeout=SETTINGS.get('request_timeout', 30),
+            per_page=CACHET.get('per_page', 100),
+            page_window=CACHET.get('page_window', 4),
+            events=events,
+            pool_size=max(10, SETTINGS.get('sync_concurrency', 8) +
+                          CACHET.get('page_window', 4)),
+            progress=health.progress
         )
+        cachet.session.hooks['response'].append(health.request_hook)
+
+        sla = SlaEngine(SETTINGS.get('sla_anchor_interval', 3600))
+
+        if trace_mode == 'replay' and SETTINGS.get('soak_cycles'):
+            monitor = SoakMonitor(
+                SETTINGS.get('soak_rss_budget', 20),
+                SETTINGS.get('soak_traced_budget', 10),
+                SETTINGS.get('soak_objects_budget', 10000),
+                SETTINGS.get('soak_warmup', 10)
+            )
+            errors = soak(SETTINGS['root_service'],
+                          SETTINGS['update_metric_interval'],
+                          SETTINGS.get('sync_concurrency', 8),
+                          SETTINGS['soak_cycles'],
+                          monitor)
+            sys.exit(1 if errors else 0)
+        elif trace_mode == 'replay':
+            replay(SETTINGS['root_service'],
+                   SETTINGS['update_metric_interval'],
+                   SETTINGS.get('sync_concurrency', 8))
+            sys.exit(0)
 
         zbxtr2cachet = ''
+        Watchdog(health, exit_on_stale=SETTINGS.get('watchdog_exit', True)
+                 ).start()
+        sd_notify('READY=1')
 
         while True:
             logging.debug('Getting list of Zabbix IT Services ...')
@@ -387,7 +734,21 @@ if __name__ == '__main__':
             logging.debug('Zabbix IT Services: {}'.format(itservices))
             # Create Cachet components and components groups
             logging.debug('Syncing Zabbix with Cachet...')
-            zbxtr2cachet_new = init_cachet(itservices)
+            # Cachet outage must not stop the daemon.
+            # Keep running workers and try to sync later
+            try:
+                zbxtr2cachet_new = init_cachet(
+                    itservices, SETTINGS.get('sync_concurrency', 8)
+                )
+                if zbxtr2cachet != zbxtr2cachet_new:
+                    # Create mapping between metrics and IT services
+                    metrics_mapping = init_metrics(itservices)
+            except CachetHttpError as err:
+                logging.warning('Can not sync with Cachet: {}'.format(err))
+                health.beat('MainThread')
+                health.idle('MainThread', SETTINGS['update_comp_interval'])
+                time.sleep(SETTINGS['update_comp_interval'])
+                continue
 
             if not zbxtr2cachet_new:
                 logging.error('Sorry, can not create Zabbix <> Cachet mapping '
@@ -409,9 +770,11 @@ if __name__ == '__main__':
                 event.set()
                 # Wait until tread die
                 while inc_update_t.is_alive():
+                    health.progress()
                     time.sleep(1)
                 logging.info('Stopped inc_update_t')
                 while metric_update_t.is_alive():
+                    health.progress()
                     time.sleep(1)
                 logging.info('Stopped metric_update_t')
                 event.clear()
@@ -419,24 +782,27 @@ if __name__ == '__main__':
                 inc_update_t = threading.Thread(
                     name='Trigger Watcher',
                     target=triggers_watcher_worker,
-                    args=(zbxtr2cachet, SETTINGS['update_inc_interval'], event)
+                    args=(zbxtr2cachet, SETTINGS['update_inc_interval'], event,
+                          SETTINGS.get('trigger_poll_intervals'),
+                          SETTINGS.get('group_poll_intervals'),
+                          SETTINGS.get('breaker_timeout', 30))
                 )
 
                 inc_update_t.daemon = True
                 inc_update_t.start()
 
-                # Create mapping between metrics and IT services
-                metrics_mapping = init_metrics(itservices)
-
                 # Run metric updater
                 metric_update_t = threading.Thread(
                     name='Metrics Updater',
                     target=metrics_updater_worker,
-                    args=(metrics_mapping, SETTINGS['update_metric_interval'], event)
+                    args=(metrics_mapping, SETTINGS['update_metric_interval'],
+                          SETTINGS.get('sla_window', 'interval'), event)
                 )
 
                 metric_update_t.daemon = True
                 metric_update_t.start()
+            health.beat('MainThread')
+            health.idle('MainThread', SETTINGS['update_comp_interval'])
             time.sleep(SETTINGS['update_comp_interval'])
     except KeyboardInterrupt:
         event.set()
@@ -444,4 +810,9 @@ if __name__ == '__main__':
     except Exception as e:
         logging.error(e)
         exit_status = 1
+    finally:
+        if adapter is not None:
+            adapter.close()
+        if events is not None:
+            events.close()
     sys.exit(exit_status)